@@ -43,32 +43,50 @@ import seaborn as sns
 import matplotlib.pyplot as plt
 from pathlib import Path
 from tqdm import tqdm
+from joblib import Parallel, cpu_count, delayed
+from numba import njit, prange
+from threadpoolctl import threadpool_limits
 from scipy import stats
 from typing import Tuple, Dict, Union
-from scipy.spatial.distance import cdist
+from sklearn.base import clone
 from sklearn.model_selection import KFold
 from sklearn.tree import DecisionTreeClassifier
 from sklearn.neural_network import MLPClassifier
 from sklearn.decomposition import PCA
-from sklearn.metrics import f1_score, mean_squared_error, jaccard_score, accuracy_score, recall_score
+from sklearn.metrics import f1_score, mean_squared_error
 from sklearn.exceptions import ConvergenceWarning
 from sklearn.ensemble import RandomForestRegressor, RandomForestClassifier
 from sklearn.linear_model import Lasso, Ridge, ElasticNet, LogisticRegression
-from dython.nominal import compute_associations, numerical_encoding
+from dython.nominal import compute_associations, numerical_encoding, theils_u
 from table_evaluator.viz import *
 from table_evaluator.metrics import *
 from table_evaluator.notebook import visualize_notebook, isnotebook, EvaluationResult
 from table_evaluator.utils import dict_to_df
 
 
+@njit(parallel=True, fastmath=True)
+def _min_row_distances(real: np.ndarray, fake: np.ndarray) -> np.ndarray:
+    # Euclidean distance from every real row to its nearest fake row, without building the full distance matrix.
+    min_distances = np.empty(real.shape[0])
+    for i in prange(real.shape[0]):
+        best = np.inf
+        for j in range(fake.shape[0]):
+            dist = 0.0
+            for k in range(real.shape[1]):
+                diff = real[i, k] - fake[j, k]
+                dist += diff * diff
+            if dist < best:
+                best = dist
+        min_distances[i] = np.sqrt(best)
+    return min_distances
+
+
 class TableEvaluator:
 
     def __init__(self, real: pd.DataFrame, fake: pd.DataFrame, cat_cols=None, unique_thresh=0, metric='pearsonr',
                  verbose=False, n_samples=None, name: str = None, seed=1337):
         self.name = name
         self.unique_thresh = unique_thresh
-        self.real = real.copy()
-        self.fake = fake.copy()
         self.comparison_metric = getattr(stats, metric)
         self.verbose = verbose
         self.random_seed = seed
@@ -90,25 +108,48 @@ class TableEvaluator:
 
         # Make sure the number of samples is equal in both datasets.
         if n_samples is None:
-            self.n_samples = min(len(self.real), len(self.fake))
+            self.n_samples = min(len(real), len(fake))
         elif len(fake) >= n_samples and len(real) >= n_samples:
             self.n_samples = n_samples
         else:
             raise Exception(f'Make sure n_samples < len(fake/real). len(real): {len(real)}, len(fake): {len(fake)}')
 
-        self.real = self.real.sample(self.n_samples)
-        self.fake = self.fake.sample(self.n_samples)
+        rng = np.random.default_rng(self.random_seed)
+        self.real = real.iloc[rng.choice(len(real), self.n_samples, replace=False)].reset_index(drop=True)
+        self.fake = fake.iloc[rng.choice(len(fake), self.n_samples, replace=False)].reset_index(drop=True)
         assert len(self.real) == len(self.fake), f'len(real) != len(fake)'
 
-        self.real.loc[:, self.categorical_columns] = self.real.loc[:, self.categorical_columns].fillna('[NAN]').astype(
-            str)
-        self.fake.loc[:, self.categorical_columns] = self.fake.loc[:, self.categorical_columns].fillna('[NAN]').astype(
-            str)
+        self.real[self.categorical_columns] = self.real[self.categorical_columns].fillna('[NAN]').astype(str)
+        self.fake[self.categorical_columns] = self.fake[self.categorical_columns].fillna('[NAN]').astype(str)
+
+        # Impute numerical columns with their mean
+        self.real.fillna(self.real[self.numerical_columns].mean().to_dict(), inplace=True)
+        self.fake.fillna(self.fake[self.numerical_columns].mean().to_dict(), inplace=True)
+
+        # Keep the full precision frames until the copy checks hash them
+        self._hash_cache = {}
+        self._hash_sources = {'real': self.real, 'fake': self.fake}
 
-        self.real.loc[:, self.numerical_columns] = self.real.loc[:, self.numerical_columns].fillna(
-            self.real[self.numerical_columns].mean())
-        self.fake.loc[:, self.numerical_columns] = self.fake.loc[:, self.numerical_columns].fillna(
-            self.fake[self.numerical_columns].mean())
+        float32_columns = {column: np.float32 for column in self.numerical_columns}
+        self.real = self.real.astype(float32_columns)
+        self.fake = self.fake.astype(float32_columns)
+
+        self._assoc_cache = {}
+        self._num_cache = None
+        self._num_onehot_cache = None
+
+    def _assocs(self, which: str) -> pd.DataFrame:
+        if which not in self._assoc_cache:
+            self._assoc_cache[which] = compute_associations(getattr(self, which),
+                                                            nominal_columns=self.categorical_columns, theil_u=True)
+        return self._assoc_cache[which]
+
+    def _row_hashes(self, which: str) -> pd.Series:
+        if which not in self._hash_cache:
+            # Hash with a common numerical dtype, hash_pandas_object hashes int 1 and float 1.0 differently.
+            ds = self._hash_sources.pop(which).astype({column: np.float64 for column in self.numerical_columns})
+            self._hash_cache[which] = pd.util.hash_pandas_object(ds, index=False)
+        return self._hash_cache[which]
 
     def plot_mean_std(self, fname=None):
         plot_mean_std(self.real, self.fake, fname=fname)
@@ -120,10 +161,11 @@ class TableEvaluator:
 
         max_len = 0
         # Increase the length of plots if the labels are long
-        if not self.real.select_dtypes(include=['object']).empty:
+        object_ds = self.real.select_dtypes(include=['object'])
+        if not object_ds.empty:
             lengths = []
-            for d in self.real.select_dtypes(include=['object']):
-                lengths.append(max([len(x.strip()) for x in self.real[d].unique().tolist()]))
+            for d in object_ds:
+                lengths.append(max([len(x.strip()) for x in object_ds[d].unique().tolist()]))
             max_len = max(lengths)
 
         row_height = 6 + (max_len // 30)
@@ -132,7 +174,7 @@ class TableEvaluator:
         axes = ax.flatten()
         for i, col in enumerate(self.real.columns):
             r = self.real[col]
-            f = self.fake.iloc[:, self.real.columns.tolist().index(col)]
+            f = self.fake[col]
             cdf(r, f, col, 'Cumsum', ax=axes[i])
         plt.tight_layout(rect=[0, 0.02, 1, 0.98])
 
@@ -162,8 +204,8 @@ class TableEvaluator:
         else:
             raise ValueError(f'`how` parameter must be in [euclidean, mae, rmse]')
 
-        real_corr = compute_associations(self.real, nominal_columns=self.categorical_columns, theil_u=True)
-        fake_corr = compute_associations(self.fake, nominal_columns=self.categorical_columns, theil_u=True)
+        real_corr = self._assocs('real')
+        fake_corr = self._assocs('fake')
 
         return distance_func(
             real_corr.values,
@@ -173,11 +215,12 @@ class TableEvaluator:
     def plot_pca(self, fname=None):
         real, fake = self.convert_numerical()
 
-        pca_r = PCA(n_components=2)
-        pca_f = PCA(n_components=2)
+        # Only two components are needed, so a randomized SVD is much cheaper than the full decomposition.
+        pca_r = PCA(n_components=2, svd_solver='randomized', random_state=self.random_seed)
+        pca_f = PCA(n_components=2, svd_solver='randomized', random_state=self.random_seed)
 
-        real_t = pca_r.fit_transform(real)
-        fake_t = pca_f.fit_transform(fake)
+        real_t = pca_r.fit_transform(real.to_numpy(dtype=np.float32))
+        fake_t = pca_f.fit_transform(fake.to_numpy(dtype=np.float32))
 
         fig, ax = plt.subplots(1, 2, figsize=(12, 6))
         fig.suptitle('First two components of PCA', fontsize=16)
@@ -192,24 +235,27 @@ class TableEvaluator:
         plt.show()
 
     def get_copies(self, return_len: bool = False) -> Union[pd.DataFrame, int]:
-        real_hashes = self.real.apply(lambda x: hash(tuple(x)), axis=1)
-        fake_hashes = self.fake.apply(lambda x: hash(tuple(x)), axis=1)
+        real_hashes = self._row_hashes('real')
+        fake_hashes = self._row_hashes('fake')
 
-        dup_idxs = fake_hashes.isin(real_hashes.values)
-        dup_idxs = dup_idxs[dup_idxs == True].sort_index().index.tolist()
+        dup_mask = np.isin(fake_hashes.to_numpy(), real_hashes.to_numpy())
+        dup_idxs = np.flatnonzero(dup_mask)
 
         if self.verbose:
             print(f'Nr copied columns: {len(dup_idxs)}')
-        copies = self.fake.loc[dup_idxs, :]
 
         if return_len:
-            return len(copies)
+            return len(dup_idxs)
         else:
-            return copies
+            return self.fake.iloc[dup_idxs]
 
     def get_duplicates(self, return_values: bool = False) -> Tuple[Union[pd.DataFrame, int], Union[pd.DataFrame, int]]:
-        real_duplicates = self.real[self.real.duplicated(keep=False)]
-        fake_duplicates = self.fake[self.fake.duplicated(keep=False)]
+        duplicates = []
+        for ds_name in ['real', 'fake']:
+            _, inverse, counts = np.unique(self._row_hashes(ds_name).to_numpy(), return_inverse=True,
+                                           return_counts=True)
+            duplicates.append(getattr(self, ds_name).iloc[np.flatnonzero(counts[inverse] > 1)])
+        real_duplicates, fake_duplicates = duplicates
         if return_values:
             return real_duplicates, fake_duplicates
         else:
@@ -219,18 +265,27 @@ class TableEvaluator:
     def fit_estimators(self):
 
         if self.verbose:
-            print(f'\nFitting real')
-        for i, c in enumerate(self.r_estimators):
-            if self.verbose:
-                print(f'{i + 1}: {type(c).__name__}')
-            c.fit(self.real_x_train, self.real_y_train)
+            self._print_estimators()
 
-        if self.verbose:
-            print(f'\nFitting fake')
+        self._fit_parallel(self._fit_jobs())
+
+    def _print_estimators(self):
+        print(f'\nFitting real')
+        for i, c in enumerate(self.r_estimators):
+            print(f'{i + 1}: {type(c).__name__}')
+        print(f'\nFitting fake')
         for i, c in enumerate(self.f_estimators):
-            if self.verbose:
-                print(f'{i + 1}: {type(c).__name__}')
-            c.fit(self.fake_x_train, self.fake_y_train)
+            print(f'{i + 1}: {type(c).__name__}')
+
+    def _fit_jobs(self) -> list:
+        return [delayed(c.fit)(self.real_x_train, self.real_y_train) for c in self.r_estimators] + \
+               [delayed(c.fit)(self.fake_x_train, self.fake_y_train) for c in self.f_estimators]
+
+    @staticmethod
+    def _fit_parallel(jobs: list):
+        # One thread per fit, at most one per core, and single-threaded BLAS inside each fit.
+        with threadpool_limits(limits=1):
+            Parallel(n_jobs=min(len(jobs), cpu_count()), prefer='threads')(jobs)
 
     def score_estimators(self):
         if self.target_type == 'class':
@@ -239,15 +294,8 @@ class TableEvaluator:
                                                                   self.estimator_names):
                 for dataset, target, dataset_name in zip([self.real_x_test, self.fake_x_test],
                                                          [self.real_y_test, self.fake_y_test], ['real', 'fake']):
-                    predictions_classifier_real = r_classifier.predict(dataset)
-                    predictions_classifier_fake = f_classifier.predict(dataset)
-                    f1_r = f1_score(target, predictions_classifier_real, average='micro')
-                    f1_f = f1_score(target, predictions_classifier_fake, average='micro')
-                    accuracy_r = accuracy_score(target, predictions_classifier_real)
-                    accuracy_f = accuracy_score(target, predictions_classifier_fake)
-                    recall_r = recall_score(target, predictions_classifier_real, average='micro')
-                    recall_f = recall_score(target, predictions_classifier_fake, average='micro')
-                    jac_sim = jaccard_score(predictions_classifier_real, predictions_classifier_fake, average='micro')
+                    f1_r = f1_score(target, r_classifier.predict(dataset), average='micro')
+                    f1_f = f1_score(target, f_classifier.predict(dataset), average='micro')
                     row = {'index': f'{estimator_name}_{dataset_name}', 'f1_real': f1_r, 'f1_fake': f1_f}
                     rows.append(row)
             results = pd.DataFrame(rows).set_index('index')
@@ -280,21 +328,15 @@ class TableEvaluator:
         total_metrics = pd.DataFrame()
         for ds_name in ['real', 'fake']:
             ds = getattr(self, ds_name)
-            metrics = {}
             # TODO: add discrete columns as factors
             num_ds = ds[self.numerical_columns]
 
-            for idx, value in num_ds.mean().items():
-                metrics[f'mean_{idx}'] = value
-            for idx, value in num_ds.median().items():
-                metrics[f'median_{idx}'] = value
-            for idx, value in num_ds.std().items():
-                metrics[f'std_{idx}'] = value
-            for idx, value in num_ds.var().items():
-                metrics[f'variance_{idx}'] = value
-            total_metrics[ds_name] = metrics.values()
-
-        total_metrics.index = metrics.keys()
+            agg = num_ds.agg(['mean', 'median', 'std'])
+            # The variance is the squared std, so it doesn't need another pass over the data.
+            agg.loc['variance'] = agg.loc['std'] ** 2
+            total_metrics[ds_name] = agg.to_numpy().ravel()
+
+        total_metrics.index = [f'{stat}_{col}' for stat in agg.index for col in agg.columns]
         self.statistical_results = total_metrics
         if self.verbose:
             print('\nBasic statistical attributes:')
@@ -306,11 +348,9 @@ class TableEvaluator:
     def correlation_correlation(self) -> float:
         total_metrics = pd.DataFrame()
         for ds_name in ['real', 'fake']:
-            ds = getattr(self, ds_name)
-            corr_df = compute_associations(ds, nominal_columns=self.categorical_columns, theil_u=True)
+            corr_df = self._assocs(ds_name)
             values = corr_df.values
-            values = values[~np.eye(values.shape[0], dtype=bool)].reshape(values.shape[0], -1)
-            total_metrics[ds_name] = values.flatten()
+            total_metrics[ds_name] = values[~np.eye(values.shape[0], dtype=bool)]
 
         self.correlation_correlations = total_metrics
         corr, p = self.comparison_metric(total_metrics['real'], total_metrics['fake'])
@@ -320,26 +360,48 @@ class TableEvaluator:
         return corr
 
     def convert_numerical(self) -> Tuple[pd.DataFrame, pd.DataFrame]:
-        real = self.real
-        fake = self.fake
-        for c in self.categorical_columns:
-            if real[c].dtype == 'object':
-                real[c] = pd.factorize(real[c], sort=True)[0]
-                fake[c] = pd.factorize(fake[c], sort=True)[0]
-
-        return real, fake
+        if self._num_cache is None:
+            # Encode copies so self.real and self.fake keep their original values.
+            real = self.real.copy()
+            fake = self.fake.copy()
+            for c in self.categorical_columns:
+                if real[c].dtype == 'object':
+                    # Factorize both columns together so a category gets the same code in real and fake.
+                    codes = pd.factorize(pd.concat([real[c], fake[c]]), sort=True)[0]
+                    real[c] = codes[:len(real)]
+                    fake[c] = codes[len(real):]
+            self._num_cache = real, fake
+
+        return self._num_cache
 
     def convert_numerical_one_hot(self) -> Tuple[pd.DataFrame, pd.DataFrame]:
-        real = numerical_encoding(self.real, nominal_columns=self.categorical_columns)
-        columns = sorted(real.columns.tolist())
-        real = real[columns]
-        fake = numerical_encoding(self.fake, nominal_columns=self.categorical_columns)
-        for col in columns:
-            if col not in fake.columns.tolist():
-                fake[col] = 0
-        fake = fake[columns]
-
-        return real, fake
+        if self._num_onehot_cache is None:
+            real = numerical_encoding(self.real, nominal_columns=self.categorical_columns)
+            columns = sorted(real.columns.tolist())
+            real = real.reindex(columns=columns)
+            # One-hot columns of categories that don't occur in fake are all zeros.
+            fake = numerical_encoding(self.fake, nominal_columns=self.categorical_columns)
+            fake = fake.reindex(columns=columns, fill_value=0)
+            self._num_onehot_cache = real, fake
+
+        return self._num_onehot_cache
+
+    def _make_fold(self, real_x: pd.DataFrame, real_y: pd.Series, fake_x: pd.DataFrame, fake_y: pd.Series,
+                   train_index: np.ndarray, test_index: np.ndarray) -> 'TableEvaluator':
+        # Shallow copy holding the splits and estimators of a single fold.
+        fold = copy.copy(self)
+        fold.real_x_train = real_x.iloc[train_index]
+        fold.real_x_test = real_x.iloc[test_index]
+        fold.real_y_train = real_y.iloc[train_index]
+        fold.real_y_test = real_y.iloc[test_index]
+        fold.fake_x_train = fake_x.iloc[train_index]
+        fold.fake_x_test = fake_x.iloc[test_index]
+        fold.fake_y_train = fake_y.iloc[train_index]
+        fold.fake_y_test = fake_y.iloc[test_index]
+
+        fold.r_estimators = [clone(e) for e in self.estimators]
+        fold.f_estimators = [clone(e) for e in self.estimators]
+        return fold
 
     def estimator_evaluation(self, target_col: str, target_type: str = 'class', kfold: bool = False) -> float:
         
@@ -372,39 +434,39 @@ class TableEvaluator:
                 LogisticRegression(multi_class='auto', solver='lbfgs', max_iter=500, random_state=42),
                 RandomForestClassifier(n_estimators=10, random_state=42),
                 DecisionTreeClassifier(random_state=42),
-                MLPClassifier([50, 50], solver='adam', activation='relu', learning_rate='adaptive', random_state=42),
+                MLPClassifier([50, 50], solver='adam', activation='relu', learning_rate='adaptive', early_stopping=True,
+                              n_iter_no_change=10, validation_fraction=0.1, random_state=42),
             ]
         else:
             raise ValueError(f'target_type must be \'regr\' or \'class\'')
 
         self.estimator_names = [type(clf).__name__ for clf in self.estimators]
 
+        for estimator in self.estimators:
+            assert hasattr(estimator, 'fit')
+            assert hasattr(estimator, 'score')
+
         # K Fold
         kf = KFold(n_splits=5)
-        res = []
-        for train_index, test_index in kf.split(real_y):
-            self.real_x_train = real_x.iloc[train_index]
-            self.real_x_test = real_x.iloc[test_index]
-            self.real_y_train = real_y.iloc[train_index]
-            self.real_y_test = real_y.iloc[test_index]
-            self.fake_x_train = fake_x.iloc[train_index]
-            self.fake_x_test = fake_x.iloc[test_index]
-            self.fake_y_train = fake_y.iloc[train_index]
-            self.fake_y_test = fake_y.iloc[test_index]
-
-            self.r_estimators = copy.deepcopy(self.estimators)
-            self.f_estimators = copy.deepcopy(self.estimators)
-
-            for estimator in self.estimators:
-                assert hasattr(estimator, 'fit')
-                assert hasattr(estimator, 'score')
-
-            self.fit_estimators()
-            res.append(self.score_estimators())
-
-            # Break the loop if we don't want the kfold
-            if not kfold:
-                break
+        splits = list(kf.split(real_y))
+        # Only use the first fold if we don't want the kfold
+        if not kfold:
+            splits = splits[:1]
+
+        folds = [self._make_fold(real_x, real_y, fake_x, fake_y, train_index, test_index)
+                 for train_index, test_index in splits]
+
+        if self.verbose:
+            folds[-1]._print_estimators()
+
+        # Fit every estimator of every fold in one pool
+        self._fit_parallel([job for fold in folds for job in fold._fit_jobs()])
+        res = [fold.score_estimators() for fold in folds]
+
+        # Keep the splits and fitted estimators of the last fold on the evaluator
+        for attr in ['r_estimators', 'f_estimators', 'real_x_train', 'real_x_test', 'real_y_train', 'real_y_test',
+                     'fake_x_train', 'fake_x_test', 'fake_y_train', 'fake_y_test']:
+            setattr(self, attr, getattr(folds[-1], attr))
 
         self.estimators_scores = pd.concat(res).groupby(level=0).mean()
         if self.verbose:
@@ -427,23 +489,20 @@ class TableEvaluator:
             n_samples = len(self.real)
 
         real, fake = self.convert_numerical_one_hot()
+        assert real.columns.tolist() == fake.columns.tolist()
 
-        columns = sorted(real.columns.tolist())
-        real = real[columns]
+        # Standardize copies, the encoded frames are cached
+        real_arr = real.to_numpy(dtype=np.float32, copy=True)
+        fake_arr = fake.to_numpy(dtype=np.float32, copy=True)
 
-        for col in columns:
-            if col not in fake.columns.tolist():
-                fake[col] = 0
-        fake = fake[columns]
+        # Standardize all non-binary columns at once, binary columns keep shift 0 and scale 1
+        non_binary = real.nunique().to_numpy() > 2
+        for arr in [real_arr, fake_arr]:
+            arr -= np.where(non_binary, arr.mean(axis=0), 0).astype(np.float32)
+            arr /= np.where(non_binary, arr.std(axis=0, ddof=1), 1).astype(np.float32)
 
-        for column in real.columns.tolist():
-            if len(real[column].unique()) > 2:
-                real[column] = (real[column] - real[column].mean()) / real[column].std()
-                fake[column] = (fake[column] - fake[column].mean()) / fake[column].std()
-        assert real.columns.tolist() == fake.columns.tolist()
-
-        distances = cdist(real[:n_samples], fake[:n_samples])
-        min_distances = np.min(distances, axis=1)
+        min_distances = _min_row_distances(np.ascontiguousarray(real_arr[:n_samples]),
+                                           np.ascontiguousarray(fake_arr[:n_samples]))
         min_mean = np.mean(min_distances)
         min_std = np.std(min_distances)
         return min_mean, min_std
@@ -451,8 +510,21 @@ class TableEvaluator:
     def column_correlations(self):
 
         real, fake = self.convert_numerical()
+        numerical_columns = [column for column in real.columns if column not in self.categorical_columns]
+
+        # Pearson correlation between every sorted real column and its sorted fake counterpart, in one pass.
+        real_num = np.sort(real[numerical_columns].to_numpy(dtype=np.float32), axis=0)
+        fake_num = np.sort(fake[numerical_columns].to_numpy(dtype=np.float32), axis=0)
+        real_num -= real_num.mean(axis=0)
+        fake_num -= fake_num.mean(axis=0)
+        numerical_corr = (real_num * fake_num).sum(axis=0) / np.sqrt(
+            (real_num ** 2).sum(axis=0) * (fake_num ** 2).sum(axis=0))
+
+        # Only the categorical columns need Theil's U.
+        categorical_corr = [theils_u(real[column].sort_values(), fake[column].sort_values())
+                            for column in self.categorical_columns]
 
-        return column_correlations(real, fake, self.categorical_columns)
+        return np.mean(np.concatenate([numerical_corr, categorical_corr]))
 
     def evaluate(self, target_col: str, target_type: str = 'class', metric: str = None, verbose: bool = None,
                  n_samples_distance: int = 20000, kfold: bool = False, notebook: bool = False, return_outputs: bool = False) -> Dict: